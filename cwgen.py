@@ -1,11 +1,12 @@
 #!/usr/bin/env python3
 from argparse import ArgumentParser, FileType
 import csv
+import functools
 import itertools
 import math
 import random
-import struct
 
+import numpy as np
 import wave
 
 SAMPWIDTH = 2 # 16-bit audio
@@ -53,6 +54,23 @@ CHARS = {
     '.': '.-.-.-',
     }
 
+ELEMENT_EVENTS = {
+    '.': (True, 1),
+    '-': (True, 3),
+    ' ': (False, 1),
+    }
+
+def cw_to_events(elems):
+    events = []
+    for elem in elems:
+        if events:
+            events.append((False, 1))
+        events.append(ELEMENT_EVENTS[elem])
+    events.append((False, 3))
+    return tuple(events)
+
+EVENTS = {char: cw_to_events(elems) for char, elems in CHARS.items()}
+
 def normalise_char(char):
     if char.isspace():
         return ' '
@@ -62,37 +80,64 @@ def normalise_special_characters(char):
     from unidecode import unidecode
     return unidecode(char)
 
-def char_to_cw(char, normalise):
+def char_to_events(char, normalise):
     if normalise:
         char = normalise_special_characters(char)
     char = normalise_char(char)
 
-    return CHARS[char]
-
-def cycle_n(xs, n):
-    length = len(xs)
-    periods = math.floor(n / length)
-    rest = n - periods * length
-    return periods * xs + xs[:rest]
-
-def sine_wave(frequency, duration, frame_rate=44100, amplitude=0.5):
-    period = int(frame_rate / frequency)
-    amp = min(max(amplitude, 0.0), 1.0)
-    lookup_table = [amplitude *
-            math.sin(2.0 * math.pi * frequency * (i%period) / frame_rate)
-            for i in range(period)]
-
-    return cycle_n(lookup_table, int(duration * frame_rate / 1000))
-
-def noise_generator(kind, duration, frame_rate=44100, amplitude=0.5):
+    return EVENTS[char]
+
+def cycle_n(xs, n, start=0):
+    start %= len(xs)
+    head = xs[start:start + n]
+    if len(head) == n:
+        return head
+    return np.concatenate((head, np.resize(xs, n - len(head))))
+
+@functools.lru_cache()
+def make_sine(frequency, frame_rate=44100, amplitude=0.5):
+    step = 2.0 * math.pi * frequency / frame_rate
+
+    if not (float(frequency).is_integer() and float(frame_rate).is_integer()):
+        def sine(start, n):
+            t = np.arange(start, start + n, dtype=np.float64)
+            return (amplitude * np.sin(step * t)).astype(np.float32)
+        return sine
+
+    period = int(frame_rate) // math.gcd(int(frequency), int(frame_rate))
+    t = np.arange(period, dtype=np.float64)
+    table = (amplitude *
+            np.sin(2.0 * math.pi * frequency * t / frame_rate)).astype(np.float32)
+    # cycle_n may return a view, and the table is shared through lru_cache
+    table.flags.writeable = False
+
+    def sine(start, n):
+        return cycle_n(table, n, start)
+    return sine
+
+# Returns one second of noise; callers loop it with cycle_n
+def noise_generator(kind, frame_rate=44100, amplitude=0.5):
     from acoustics.generator import noise
-    samples = noise(frame_rate, kind)
-    samples = [s / 5 * amplitude for s in samples]
-
-    return cycle_n(samples, int(duration * frame_rate / 1000))
+    samples = np.asarray(noise(frame_rate, kind), dtype=np.float32)
+    samples *= amplitude / 5
+    return samples
+
+def key_wave(on_flags, durations, frequency, frame_rate=44100, amplitude=0.5,
+        start=0):
+    lengths = (np.asarray(durations, dtype=np.float64) * frame_rate / 1000).astype(np.int64)
+    sine = make_sine(frequency, frame_rate, amplitude)
+
+    offsets = np.zeros(len(lengths), dtype=np.int64)
+    np.cumsum(lengths[:-1], out=offsets[1:])
+    out = np.zeros(lengths.sum(), dtype=np.float32)
+    for on, o, n in zip(on_flags, offsets, lengths):
+        if on:
+            out[o:o + n] = sine(start + o, n)
+    return out
 
 def mix(*signals):
-    return map(sum, zip(*signals))
+    length = min(len(signal) for signal in signals)
+    return functools.reduce(np.add, (signal[:length] for signal in signals))
 
 class CWGenerator:
     def __init__(self,
@@ -108,81 +153,88 @@ class CWGenerator:
         self.length_standard_deviation = length_standard_deviation
         self.length_drift = length_drift
         self.normalise_special_characters = normalise_special_characters
-
-    def dot_length(self):
-        length = math.floor(1200 / self.wpm)
-        dev = length * self.length_standard_deviation
-        length = max(0, min(max(length - dev, random.gauss(length, dev)), length + dev))
-        return length
-
-    def dash_length(self):
-        return 3 * self.dot_length()
-
-    def _produce_char(self, char):
-        elems = char_to_cw(char, self.normalise_special_characters)
-        i = 0
-        for elem in elems:
-            if elem == '.':
-                yield (True, self.dot_length())
-            elif elem == '-':
-                yield (True, self.dash_length())
-            elif elem == ' ':
-                yield (False, self.dot_length() * 1)
-            i += 1
-            if i < len(elems):
-                yield (False, self.dot_length())
-        yield (False, self.dash_length())
+        self._lookup = dict(EVENTS)
+        self._rng = random.Random()
+        self._gauss = self._rng.gauss
+        self._np_rng = np.random.default_rng()
+
+    def _char_events(self, char):
+        try:
+            return self._lookup[char]
+        except KeyError:
+            events = char_to_events(char, self.normalise_special_characters)
+            self._lookup[char] = events
+            return events
 
     def drift(self):
-        drift = random.gauss(1.0, self.length_drift)
+        drift = self._gauss(1.0, self.length_drift)
         drift = min(max(drift, 1 - self.length_drift), 1 + self.length_drift)
         self.wpm *= drift
         if self.min_wpm is not None: self.wpm = max(self.min_wpm, self.wpm)
         if self.max_wpm is not None: self.wpm = min(self.max_wpm, self.wpm)
 
-    def _produce(self, string):
+    def produce(self, string):
+        for on, duration in zip(*self.produce_stream(string)):
+            yield (bool(on), float(duration))
+
+    def produce_stream(self, string):
+        events = []
+        lengths = []
+        counts = []
         for char in string:
-            yield from self._produce_char(char)
+            char_events = self._char_events(char)
+            events.extend(char_events)
+            lengths.append(math.floor(1200 / self.wpm))
+            counts.append(len(char_events))
             self.drift()
 
-    def produce(self, string):
-        _on = False
-        _duration = 0
-        for on, duration in self._produce(string):
-            if _on != on:
-                if _duration != 0:
-                    yield (_on, _duration)
-                _on = on
-                _duration = 0
-            _duration += duration
-        if _on != False:
-            yield (_on, _duration)
+        events = np.array(events, dtype=np.int64).reshape(-1, 2)
+        lengths = np.array(lengths, dtype=np.float64)
+        dev = lengths * abs(self.length_standard_deviation)
+        dots = np.clip(self._np_rng.normal(lengths, dev), lengths - dev, lengths + dev)
+        durations = np.repeat(np.maximum(dots, 0), counts) * events[:, 1]
+
+        nonzero = durations != 0
+        on_flags = events[nonzero, 0].astype(np.bool_)
+        durations = durations[nonzero]
+        if len(on_flags) == 0:
+            return on_flags, durations
+        starts = np.flatnonzero(np.r_[True, on_flags[1:] != on_flags[:-1]])
+        on_flags = on_flags[starts]
+        durations = np.add.reduceat(durations, starts)
+        if not on_flags[-1]:
+            on_flags = on_flags[:-1]
+            durations = durations[:-1]
+        return on_flags, durations
 
 def generate_wav(stream, frame_rate=44100, frequency=600,
-        noise_kind=None, noise_level=0.0):
+        noise_kind=None, noise_level=0.0, chunk_size=64, start=0):
     max_amp = int(2 ** (8 * SAMPWIDTH - 1)) - 1
 
-    audio = []
-    length = 0
-    for on, duration in stream:
-        audio.append(sine_wave(
-                frequency=frequency,
-                duration=duration,
-                frame_rate=frame_rate,
-                amplitude=0.5 * max_amp if on else 0.0))
-        length += duration
-    audio = [a for parts in audio for a in parts]
     if noise_level > 0.0:
         noise = noise_generator(
                 noise_kind,
-                length,
                 frame_rate,
                 noise_level * max_amp)
-        audio = mix(audio, noise)
-    audio = list(map(int, audio))
-    frames = struct.pack('{0:d}h'.format(len(audio)), *audio)
 
-    return frames
+    stream = iter(stream)
+    position = start
+    while True:
+        chunk = list(itertools.islice(stream, chunk_size))
+        if len(chunk) == 0:
+            break
+        audio = key_wave(
+                [on for on, _ in chunk],
+                [duration for _, duration in chunk],
+                frequency=frequency,
+                frame_rate=frame_rate,
+                amplitude=0.5 * max_amp,
+                start=position)
+        if noise_level > 0.0:
+            audio = mix(audio, cycle_n(noise, len(audio), position))
+        position += len(audio)
+        audio = np.clip(audio, -max_amp, max_amp, out=audio).astype(np.int16)
+        yield audio.tobytes()
 
 def main():
     parser = ArgumentParser(
@@ -256,31 +308,57 @@ def main():
             wr.writerow([1 if on else 0, int(duration)])
 
     if args.wave is not None or args.play:
-        frames = generate_wav(stream, args.frame_rate, args.frequency,
-                args.noise_kind, args.noise_level)
-
+        wav = None
+        player = None
         if args.wave is not None:
             wav = wave.open(args.wave)
             wav.setnchannels(1)
             wav.setsampwidth(SAMPWIDTH)
             wav.setframerate(args.frame_rate)
-            wav.writeframes(frames)
         if args.play:
             import pyaudio
-            player = pyaudio.PyAudio()
-            player = player.open(
-                    format=player.get_format_from_width(SAMPWIDTH),
+            audio = pyaudio.PyAudio()
+            player = audio.open(
+                    format=audio.get_format_from_width(SAMPWIDTH),
                     channels=1,
                     rate=args.frame_rate,
                     output=True)
+
+        block_size = int(args.frame_rate / 4)
+        chunk_size = 64
+        done = 0
+        position = 0
+        try:
             try:
-                block_size = int(args.frame_rate / 4)
-                while len(frames) > 0:
-                    data = frames[:block_size]
-                    frames = frames[block_size:]
-                    player.write(data)
+                for frames in generate_wav(stream, args.frame_rate,
+                        args.frequency, args.noise_kind, args.noise_level,
+                        chunk_size=chunk_size):
+                    if wav is not None:
+                        wav.writeframes(frames)
+                    done += chunk_size
+                    position += len(frames) // SAMPWIDTH
+                    if player is not None:
+                        frames = memoryview(frames)
+                        for i in range(0, len(frames), block_size):
+                            player.write(bytes(frames[i:i + block_size]))
             except KeyboardInterrupt:
-                pass
+                if player is None:
+                    raise
+            finally:
+                if player is not None:
+                    player.stop_stream()
+                    player.close()
+                    audio.terminate()
+
+            # Playback was interrupted; render the rest of the WAVE file
+            if wav is not None:
+                for frames in generate_wav(stream[done:], args.frame_rate,
+                        args.frequency, args.noise_kind, args.noise_level,
+                        chunk_size=chunk_size, start=position):
+                    wav.writeframes(frames)
+        finally:
+            if wav is not None:
+                wav.close()
 
 if __name__ == '__main__':
     main()